@@ -1,8 +1,11 @@
+import heapq
 import time
 import sqlite3
 
 from dataclasses import dataclass
-from functools import partial
+from functools import lru_cache, partial
+
+import marisa_trie
 
 from textual import on
 from textual.app import App, ComposeResult
@@ -13,8 +16,8 @@ from textual.message import Message
 
 import textual.events
 
-WORD_PUNCTUATION = "'-"
-PHRASE_PUNCTUATION = "'- "
+WORD_PUNCTUATION = frozenset("'-")
+PHRASE_PUNCTUATION = frozenset("'- ")
 DOUBLE_CLICK_SECONDS = 0.3
 
 
@@ -40,41 +43,75 @@ class LookupDictionary(Provider):
             )
 
 
-def score(word, freq, prefix, total):
-    if word.lower() == prefix.lower():
-        return 1.0
-    else:
-        return freq / total
-
-
 class Dictionary:
     DICTIONARY = "dict/web1913.db"
     LOOKUP = "SELECT d.word, d.definition FROM definitions d, word_index w WHERE d.definition_id = w.definition_id AND (w.word = ? or w.word = ?)"
-    MATCH = "SELECT word, frequency FROM word_index WHERE word like ? or word like ? ORDER BY frequency DESC LIMIT 10"
+    WORDS = "SELECT word, frequency FROM word_index"
+    MATCH_LIMIT = 10
+    MATCH_CACHE_SIZE = 2048
 
     def __init__(self):
-        self.conn = sqlite3.connect(Dictionary.DICTIONARY)
+        # read-only and in autocommit mode, the viewer never writes; rows are
+        # plain tuples with no type detection
+        self.conn = sqlite3.connect(
+            f"file:{Dictionary.DICTIONARY}?mode=ro",
+            uri=True,
+            isolation_level=None,
+            detect_types=0,
+            cached_statements=256,
+        )
+        self.conn.execute("PRAGMA cache_size = -16000")
+        self.conn.execute("PRAGMA mmap_size = 268435456")
+        # prefix matching is answered from memory, keyed by the lowercased word,
+        # each record is an index into self._words
+        self._words = words = self.conn.execute(Dictionary.WORDS).fetchall()
+        keys = [w.lower() for w, _ in words]
+        self._trie = marisa_trie.RecordTrie(
+            "<I", ((k, (i,)) for i, k in enumerate(keys))
+        )
+        # the empty prefix and single letters match most of the trie, so their
+        # top matches are worked out once here, in one pass by frequency
+        self._top = {}
+        for i in sorted(range(len(words)), key=lambda i: words[i][1], reverse=True):
+            for prefix in ("", keys[i][:1]):
+                top = self._top.setdefault(prefix, [])
+                if len(top) < Dictionary.MATCH_LIMIT:
+                    top.append((keys[i], words[i]))
+        # the palette searches on every keystroke, so backspacing and retyping
+        # repeat prefixes; the database is never written, so no invalidation
+        self._match = lru_cache(maxsize=Dictionary.MATCH_CACHE_SIZE)(self._match)
+
+    def close(self):
+        self._match.cache_clear()
+        self.conn.close()
 
     def lookup(self, word):
-        cur = self.conn.cursor()
-        try:
-            rs = cur.execute(Dictionary.LOOKUP, (word.capitalize(), word.lower()))
-            return rs.fetchall()
-        finally:
-            cur.close()
+        # the connection's statement cache keeps LOOKUP compiled between calls
+        rs = self.conn.execute(Dictionary.LOOKUP, (word.capitalize(), word.lower()))
+        return rs.fetchall()
 
     def match(self, prefix):
-        cur = self.conn.cursor()
-        try:
-            rs = cur.execute(
-                Dictionary.MATCH, (f"{prefix.capitalize()}%", f"{prefix.lower()}%")
+        return self._match(prefix.lower())
+
+    def _match(self, prefix_lc):
+        res = self._top.get(prefix_lc) if len(prefix_lc) <= 1 else None
+        if res is None:
+            words = self._words
+            res = heapq.nlargest(
+                Dictionary.MATCH_LIMIT,
+                ((key, words[i]) for key, (i,) in self._trie.iteritems(prefix_lc)),
+                key=lambda hit: hit[1][1],
             )
-            res = list(rs.fetchall())
-            total = sum(f for _, f in res)
-            words = [(w, score(w, f, prefix, total)) for w, f in res]
-            return words
-        finally:
-            cur.close()
+        total = sum(f for _, (_, f) in res)
+        inv_total = 1.0 / total if total else 0.0
+        # an exact match scores 1.0, otherwise score by relative frequency,
+        # comparing against the trie key as it is already lowercased
+        scored = []
+        for key, (w, f) in res:
+            exact = float(key == prefix_lc)
+            scored.append((w, exact + (1.0 - exact) * f * inv_total))
+        # a tuple, as the result is shared by every hit in the cache
+        return tuple(scored)
 
 
 DICTIONARY = Dictionary()
@@ -108,18 +145,29 @@ def strip_word(word):
 
 def find_word_or_phrase(line, idx):
     """returns the word or phrase at idx"""
-    prev_curly = line[:idx].rfind("{")
-    next_curly = line.find("}", prev_curly)
-    if prev_curly > -1 and prev_curly <= idx <= next_curly:
-        return strip_phrase(line[prev_curly:next_curly])
-
-    prev_space = line[:idx].rfind(" ")
-    if prev_space == -1:
-        prev_space = 0
-    next_space = line.find(" ", prev_space + 1)
-    if next_space == -1:
-        next_space = len(line)
-    return strip_word(line[prev_space:next_space])
+    # a click past the end of the line selects the last word
+    if idx > len(line):
+        idx = len(line)
+    start = line.rfind(" ", 0, idx) + 1
+    # a {phrase} may contain spaces, so start from its word if idx is inside one
+    prev_curly = line.rfind("{", 0, start)
+    if prev_curly > -1 and line.find("}", prev_curly) >= start:
+        start = line.rfind(" ", 0, prev_curly) + 1
+    end = line.find(" ", start)
+    if end == -1:
+        end = len(line)
+    open_curly = line.find("{", start, end)
+    if open_curly > -1:
+        close_curly = line.find("}", open_curly)
+        if close_curly > -1:
+            # punctuation attached to either side of the braces selects the phrase
+            end = line.find(" ", close_curly)
+            if end == -1 or idx <= end:
+                return strip_phrase(line[open_curly : close_curly + 1])
+            return ""
+    if start < end and idx <= end:
+        return strip_word(line[start:end])
+    return ""
 
 
 class Definition(Static):
@@ -156,7 +204,8 @@ class Definition(Static):
             x, y = event.x - 1, event.y  # type: ignore
             line = text.split("\n")[y]
             res = find_word_or_phrase(line, x)
-            self.post_message(self.Selected(res))
+            if res:
+                self.post_message(self.Selected(res))
 
 
 class DictionaryApp(App):
@@ -242,4 +291,7 @@ class DictionaryApp(App):
 
 if __name__ == "__main__":
     app = DictionaryApp()
-    app.run()
+    try:
+        app.run()
+    finally:
+        DICTIONARY.close()
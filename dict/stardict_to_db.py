@@ -1,12 +1,14 @@
 import argparse
 import logging
+import multiprocessing
 import pathlib
 import struct
 import gzip
 import bz2
 import sqlite3
-import hashlib
 import collections
+import contextlib
+import os
 import string
 
 from typing import NamedTuple
@@ -126,10 +128,22 @@ CREATE TABLE IF NOT EXISTS word_index (
     PRIMARY KEY (word, definition_id),                -- Composite primary key to prevent duplicates
     FOREIGN KEY (definition_id) REFERENCES definitions(definition_id) ON DELETE CASCADE
 );
+"""
 
+# indexes are created after the bulk insert rather than maintained during it
+INDEXES = """
 -- Create an index on word for faster lookups
 CREATE INDEX IF NOT EXISTS idx_word ON definitions(word);
 """
+DROP_INDEXES = """DROP INDEX IF EXISTS idx_word"""
+
+# a failed import is redone from scratch, so trade durability for speed
+IMPORT_PRAGMAS = """
+PRAGMA journal_mode = OFF;
+PRAGMA synchronous = OFF;
+PRAGMA temp_store = MEMORY;
+PRAGMA locking_mode = EXCLUSIVE
+"""
 
 INSERT_META = """INSERT INTO meta (key, value) VALUES (?, ?)"""
 INSERT_DEFINITION = (
@@ -143,6 +157,9 @@ INSERT_DEFINITION_FTS = """INSERT INTO definitions_search (rowid, definition) SE
 
 BATCH_SIZE = 10000
 
+# the data offset and size following each word in the .idx, by idxoffsetbits
+INDEX_FIELDS = {32: struct.Struct("!II"), 64: struct.Struct("!QI")}
+
 PUNCTUATION = string.punctuation.replace("'", "")
 
 
@@ -240,31 +257,23 @@ def read_idx(path: pathlib.Path, index_offset_sz=32) -> Index:
     """
     if index_offset_sz not in {32, 64}:
         raise ValueError(f"unexpected index offset size: {index_offset_sz}")
-    sz = 4 if index_offset_sz == 32 else 8
     entries: list[IndexEntry] = []
     words: dict[bytes, list[int]] = {}
     content = open_any(path, "rb").read()
+    fields = INDEX_FIELDS[index_offset_sz]
 
     offset = 0
-    while True:
-        if offset >= len(content):
-            break
-
+    while offset < len(content):
         end = content.find(b"\0", offset)
         if end == -1:
             raise ValueError(f"corrupted file? no end found at {offset}")
 
         word = content[offset:end]
-        offset = end + 1
-        (data_offset,) = struct.unpack("!I", content[offset : offset + sz])
-        offset += sz
-        (data_size,) = struct.unpack("!I", content[offset : offset + 4])
-        offset += 4
+        data_offset, data_size = fields.unpack_from(content, end + 1)
+        offset = end + 1 + fields.size
 
+        words.setdefault(word, []).append(len(entries))
         entries.append(IndexEntry(word, data_offset, data_size))
-        if word not in words:
-            words[word] = []
-        words[word].append(len(entries) - 1)
 
     return Index(entries, words)
 
@@ -277,11 +286,13 @@ class StarDict(object):
         self.meta = read_ifo(self.files["ifo"])
         logger.debug(f"meta {self.meta}")
         self.index = read_idx(self.files["idx"])
-        self.data = open_any(self.files["dict"]).read()
+        self.data = open_any(self.files["dict"], "rb").read()
+        # slicing a memoryview is zero-copy, str() decodes straight from it
+        self._data = memoryview(self.data)
 
     def get(self, entry):
         word, offset, sz = entry
-        return word.decode("utf8"), self.data[offset : offset + sz].decode("utf8")
+        return word.decode("utf8"), str(self._data[offset : offset + sz], "utf8")
 
     def lookup(self, word):
         mo = self.index.words[word.encode("utf8")]
@@ -294,24 +305,26 @@ class StarDict(object):
             yield word, definition
 
 
-def hash(value: str) -> str:
-    sha = hashlib.sha256()
-    sha.update(value.encode("utf8"))
-    return sha.hexdigest()
-
-
-def update_freq(table: dict[str, int], desc: str):
-    words = desc.lower().split()
-    words = [word.strip(PUNCTUATION) for word in words]
-    for word in words:
-        table[word] += 1
+def count_words(definitions: list[str]) -> collections.Counter[str]:
+    "count the words in a batch of definitions, run in a worker process"
+    # count the raw tokens first, so each distinct token is only stripped once
+    tokens: collections.Counter[str] = collections.Counter()
+    for definition in definitions:
+        tokens.update(definition.lower().split())
+    table: collections.Counter[str] = collections.Counter()
+    for token, count in tokens.items():
+        table[token.strip(PUNCTUATION)] += count
+    return table
 
 
 def main(parser, args):
     stardict = StarDict(args.path)
     db_path = f"{stardict.files["ifo"].stem}.db"
     logger.debug(f"creating dictionary {db_path}")
-    conn = sqlite3.connect(db_path)
+    # autocommit mode, transactions are only the explicit BEGIN/COMMIT below
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    for sql in IMPORT_PRAGMAS.split(";"):
+        conn.execute(sql)
     for sql in SCHEMA.split(";"):
         conn.execute(sql)
 
@@ -323,44 +336,65 @@ def main(parser, args):
     cur.execute("COMMIT")
 
     # insert definitions
-    freq = collections.defaultdict(int)
+    freq: collections.Counter[str] = collections.Counter()
     dedup = {}
+    # word -> (definition_id, lowercased word), the latter keys into freq
     word_index = {}
     resolved = {}
     batch = []
     definition_id = 0
     cur.execute("BEGIN TRANSACTION")
-    for word, definition in stardict:
-        h = hash(definition)
-        if h in dedup:
-            duplicate_id = dedup[h]
-            word_index[word] = duplicate_id
-            if definition.startswith(word):
-                if duplicate_id in resolved:
-                    logger.debug(
-                        f"resolution collision between {word} and {resolved[duplicate_id]} for {definition[:40]}"
-                    )
-                resolved[duplicate_id] = word
-        else:
-            definition_id += 1
-            word_index[word] = definition_id
-            dedup[h] = definition_id
-            update_freq(freq, definition)
-            batch.append((definition_id, word, definition))
-            if len(batch) == BATCH_SIZE:
-                cur.executemany(INSERT_DEFINITION, batch)
-                batch = []
-    if batch:
-        cur.executemany(INSERT_DEFINITION, batch)
+    for sql in DROP_INDEXES.split(";"):
+        cur.execute(sql)
+    # dedup depends on iteration order so stays here, word counting is
+    # farmed out to worker processes one insert batch at a time; with a single
+    # job the words are counted in-process, a pool would only add pickling
+    jobs = args.jobs or os.cpu_count() or 1
+    counts = []
+    with multiprocessing.Pool(jobs) if jobs > 1 else contextlib.nullcontext() as pool:
+
+        def count_batch(batch):
+            definitions = [d for _, _, d in batch]
+            if pool is None:
+                freq.update(count_words(definitions))
+            else:
+                counts.append(pool.apply_async(count_words, (definitions,)))
+
+        for word, definition in stardict:
+            if definition in dedup:
+                duplicate_id = dedup[definition]
+                word_index[word] = (duplicate_id, word.lower())
+                if definition.startswith(word):
+                    if duplicate_id in resolved:
+                        logger.debug(
+                            f"resolution collision between {word} and {resolved[duplicate_id]} for {definition[:40]}"
+                        )
+                    resolved[duplicate_id] = word
+            else:
+                definition_id += 1
+                word_index[word] = (definition_id, word.lower())
+                dedup[definition] = definition_id
+                batch.append((definition_id, word, definition))
+                if len(batch) == BATCH_SIZE:
+                    cur.executemany(INSERT_DEFINITION, batch)
+                    count_batch(batch)
+                    batch = []
+        if batch:
+            cur.executemany(INSERT_DEFINITION, batch)
+            count_batch(batch)
+        for count in counts:
+            freq.update(count.get())
 
     cur.executemany(
         UPDATE_DEFINITION_WORD,
         ((word, definition_id) for definition_id, word in resolved.items()),
     )
-    cur.executemany(
-        INSERT_WORD_INDEX, ((w, word_index[w], freq[w.lower()]) for w in word_index)
-    )
+    rows = [(w, i, freq[w_lc]) for w, (i, w_lc) in word_index.items()]
+    for start in range(0, len(rows), BATCH_SIZE):
+        cur.executemany(INSERT_WORD_INDEX, rows[start : start + BATCH_SIZE])
     cur.execute(INSERT_DEFINITION_FTS)
+    for sql in INDEXES.split(";"):
+        cur.execute(sql)
 
     cur.execute("COMMIT")
     conn.close()
@@ -369,6 +403,12 @@ def main(parser, args):
 def parse_args() -> tuple[argparse.ArgumentParser, argparse.Namespace]:
     parser = argparse.ArgumentParser(usage=__doc__)
     parser.add_argument("-D", "--debug", action="store_true", help="Log debug messages")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="Number of worker processes counting words (default: CPU count)",
+    )
     parser.add_argument("path", help="Directory path containing the StarDict files")
     args = parser.parse_args()
 